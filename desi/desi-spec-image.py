@@ -20,7 +20,7 @@
 # * list each image to terminal as it's created
 # * Rework to accept input list including SDSS_NAME,targetid
 # * Output list of DESI spectrum images (list to screen each one as it's created)
-# * option to not display firefox at all i.e. headless mode (not recommended though)
+# * option to not display firefox at all i.e. headless mode (default now, set DESI_DEBUG=1 to watch)
 # * only display two DESI spectrum images at a time in firefox (currently loading one & previous one)
 #
 # TO DO:
@@ -28,44 +28,69 @@
 
 from base64 import b64decode as base64decode
 from builtins import isinstance as isa
+from collections.abc import Callable, Mapping
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache
+from itertools import count
+from logging import INFO, basicConfig, getLogger
+from os import getenv, scandir
 from pathlib import Path
-from re import sub as replace
+from queue import Queue
+from random import uniform
 from sys import platform as PLATFORM
-from time import sleep
-from typing import Final, Literal
+from sys import stdout
+from threading import Lock
+from time import monotonic, sleep
+from typing import Final, Literal, Self
 from urllib.parse import unquote as uri_decode
 
-from pandas import DataFrame, read_csv
-from selenium.common import JavascriptException, TimeoutException  # type: ignore[import-not-found]
+from pandas import read_csv
+from selenium.common import JavascriptException, TimeoutException, WebDriverException  # type: ignore[import-not-found]
 from selenium.webdriver import Firefox, FirefoxOptions, Keys  # type: ignore[import-not-found]
 from selenium.webdriver import Remote as Browser
+from selenium.webdriver.support.ui import WebDriverWait  # type: ignore[import-not-found]
 
 
 # Misc. functions
 def isapple() -> bool:
 	return PLATFORM == "darwin"
 
-def eachrow(df: DataFrame):
-	return (df).itertuples(name="DataFrameRow")
-
 def exec_js(br: Browser, js: str):
 	return (br).execute_script(js)
 
-def url2bytes(url: str) -> bytes:
-	data = replace(r"^data:[^,]*,", "", url)
-	return base64decode(data)
+def exec_async_js(br: Browser, js: str):
+	return (br).execute_async_script(js)
+
+def wait_js(br: Browser, js: str, timeout: float = 10):
+	try: return WebDriverWait(br, timeout, 0.2).until(lambda br: exec_js(br, js))
+	except TimeoutException: return None
+
+def url2file(url: str, f: Path | str, chunk: int = 1 << 20) -> int:
+	assert url.startswith("data:") and chunk % 4 == 0
+	i, f = url.index(",") + 1, aspath(f)
+	tmp = f.with_suffix(".part") # never leave a truncated file at f
+	try:
+		with open(tmp, "wb") as io: # decode chunk by chunk, without a full copy of the payload
+			n = sum(io.write(base64decode(url[k:k + chunk])) for k in range(i, len(url), chunk))
+	except BaseException:
+		tmp.unlink(missing_ok=True)
+		raise
+	tmp.replace(f)
+	return n
+
+@lru_cache(maxsize=65536)
+def aspath(f: Path | str) -> Path:
+	return f if isa(f, Path) else Path(f)
 
 def file2url(f: Path | str) -> str:
-	if not isa(f, Path): f = Path(f)
-	return uri_decode(f.absolute().as_uri())
+	return uri_decode((__cwd__ / aspath(f)).as_uri()) # same as absolute(), minus getcwd()
 
 def filesize(f: Path | str) -> int:
-	if not isa(f, Path): f = Path(f)
+	f = aspath(f)
 	return f.stat().st_size if isfile(f) else 0
 
 def isfile(f: Path | str) -> bool:
-	if not isa(f, Path): f = Path(f)
-	return f.is_file()
+	return aspath(f).is_file()
 
 def write(f: Path | str, x: bytes | str) -> int:
 	if isa(x, bytes):
@@ -77,7 +102,10 @@ def write(f: Path | str, x: bytes | str) -> int:
 
 # mypy: disable-error-code="func-returns-value"
 
+__cwd__: Final = Path.cwd()
 __dir__: Final = Path(__file__).parent
+log: Final = getLogger(__name__) # thread-safe, unlike interleaved print() calls
+debug: Final = getenv("DESI_DEBUG", "") not in ("", "0") # open the network monitor for each page, keep the original html, etc.
 
 # Set up key combination to bring up the DevTools in Firefox
 if isapple():
@@ -86,12 +114,18 @@ else:
 	netmonitor = Keys.CONTROL + Keys.SHIFT + "E"
 # https://github.com/SeleniumHQ/selenium/pull/15948 # selenium v4.34.0
 
-# Set up Firefox browser
-def init(headless: bool = False) -> Browser:
+# Set up Firefox browser, either locally or on a Selenium Grid (grid URL)
+def init(headless: bool = True, cache: Path | str = "", grid: str = "") -> Browser:
 	# https://wiki.mozilla.org/Firefox/CommandLineOptions
 	opt = FirefoxOptions()
 	opt.add_argument("-headless") if headless else None
+	opt.page_load_strategy = "eager" # return on DOMContentLoaded, see wait_js() in load()
 	opt.set_preference("browser.aboutConfig.showWarning", False)
+	opt.set_preference("browser.cache.disk.capacity", 1048576) # KiB
+	opt.set_preference("browser.cache.disk.enable", True)
+	opt.set_preference("browser.cache.disk.parent_directory", str(cache)) if cache and not grid else None # persist across runs
+	opt.set_preference("browser.cache.disk.smart_size.enabled", False)
+	opt.set_preference("browser.cache.memory.capacity", 262144) # KiB
 	opt.set_preference("browser.ctrlTab.sortByRecentlyUsed", True)
 	opt.set_preference("browser.link.open_newwindow", 3)
 	opt.set_preference("browser.menu.showViewImageInfo", True)
@@ -99,93 +133,206 @@ def init(headless: bool = False) -> Browser:
 	opt.set_preference("browser.newtabpage.activity-stream.asrouter.providers.onboarding", "{}") # TAB_GROUP_ONBOARDING_CALLOUT
 	opt.set_preference("browser.urlbar.trimURLs", False)
 	opt.set_preference("datareporting.usage.uploadEnabled", False)
-	opt.set_preference("devtools.netmonitor.persistlog", True)
+	opt.set_preference("devtools.netmonitor.persistlog", True) if debug else None
 	opt.set_preference("devtools.selfxss.count", 5)
-	opt.set_preference("devtools.webconsole.persistlog", True)
-	opt.set_preference("devtools.webconsole.timestampMessages", True)
+	opt.set_preference("devtools.webconsole.persistlog", True) if debug else None
+	opt.set_preference("devtools.webconsole.timestampMessages", True) if debug else None
+	opt.set_preference("gfx.webrender.all", True)
 	opt.set_preference("identity.fxaccounts.enabled", False)
+	opt.set_preference("layers.acceleration.force-enabled", True)
+	opt.set_preference("media.autoplay.default", 5) # block all
+	opt.set_preference("network.prefetch-next", False)
+	opt.set_preference("network.proxy.type", 0) # direct, skip system proxy lookup
 	opt.set_preference("pdfjs.externalLinkTarget", 2)
 	opt.set_preference("privacy.fingerprintingProtection.overrides", "+AllTargets,-CanvasRandomization,-CanvasImageExtractionPrompt,-CanvasExtractionBeforeUserInputIsBlocked")
 	opt.set_preference("privacy.fingerprintingProtection", True)
 	opt.set_preference("privacy.spoof_english", 2)
+	opt.set_preference("privacy.trackingprotection.enabled", True) # block analytics & ads
+	opt.set_preference("privacy.trackingprotection.socialtracking.enabled", True)
 	opt.set_preference("privacy.window.maxInnerHeight", 900)
 	opt.set_preference("privacy.window.maxInnerWidth", 1600)
 	opt.set_preference("security.OCSP.enabled", 0)
 	opt.set_preference("security.pki.crlite_mode", 2)
 	opt.set_preference("sidebar.main.tools", "history")
-	ret = Firefox(opt)
-	ret.set_page_load_timeout(6)
-	ret.set_script_timeout(3)
+	opt.set_preference("webgl.force-enabled", True)
+	ret = Browser(command_executor=grid, options=opt) if grid else Firefox(opt)
+	ret.set_page_load_timeout(15)
+	ret.set_script_timeout(10)
 	ret.set_window_size(1600, 900) if headless else None
 	return ret
 
+# Limit the rate of requests shared by all workers, regardless of their number
+class RateLimit:
+	def __init__(self, rate: float) -> None:
+		self.gap, self.next, self.lock = 1 / rate, 0.0, Lock()
+
+	def wait(self) -> None:
+		with self.lock:
+			now = monotonic()
+			at = max(self.next, now)
+			self.next = at + self.gap
+		sleep(at - now)
+
+throttle: Final = RateLimit(10) # req/s to legacysurvey.org
+
 # Load spectrum image from a given data release (dr) of a given DESI targetid (id)
-def load(br: Browser, dr: Literal["edr", "dr1"], id: int | str) -> bytes:
+def load(br: Browser, dr: Literal["edr", "dr1"], id: int | str) -> str:
 	# https://data.desi.lbl.gov/doc/access/
+	throttle.wait()
 	br.get(f"https://www.legacysurvey.org/viewer/desi-spectrum/{dr}/targetid{id}")
-	v3 = """document.querySelector(`.bk-Column`).shadowRoot.querySelector(`.bk-Row`)
-		 .shadowRoot.querySelector(`.bk-Figure`).shadowRoot.querySelector(`.bk-Canvas`)
-		 .shadowRoot.querySelector(`canvas`).toDataURL(`image/png`)""" # lines label missing
-	v3 = """var _bk_col_row_fig = Object.values(Bokeh.index)[0].child_views[0].child_views[0]
-			return _bk_col_row_fig.export()._canvas.toDataURL(`image/png`)"""
-	v2 = """return document.querySelector(`canvas`).toDataURL(`image/png`)"""
-	try:
-		rv = str(exec_js(br, v2))
-	except JavascriptException:
-		js = "return performance.getEntriesByType(`navigation`)[0].responseStatus"
-		if (code := int(exec_js(br, js))) >= 400: raise Exception(code) # Client/Server error
-		f, g, h = __dir__ / f"html/desi-{dr}-{id}.html", "</html>", br.current_url
-		br.get(f"view-source:{h}")
-		rv = str(exec_js(br, f"return document.body.textContent"))
-		write(f"{f}.orig", rv + "\n"), write(f, rv[:rv.find(g) + len(g)] + "\n")
-		br.get(file2url(f))
-		rv = str(exec_js(br, v3))
+	ready = """var status = performance.getEntriesByType(`navigation`)[0]?.responseStatus
+		if (status >= 400) return status
+		if (typeof Bokeh != `object`) return null
+		if (parseInt(Bokeh.version) >= 3) return `v3` // canvas is in shadow DOM, may never render live
+		return document.querySelector(`canvas`)?.width > 100 ? `v2` : null""" # null: keep polling
+	rendered = "return typeof Bokeh == `object` && Object.keys(Bokeh.index).length > 0"
+	# toBlob() encodes the png off the main thread, then read it back as data URL (null on failure)
+	blob = """.toBlob(b => { if (!b) return done(null); var r = new FileReader()
+			r.onload = () => done(r.result), r.onerror = () => done(null), r.readAsDataURL(b) }, `image/png`)"""
+	v3 = """var done = arguments[arguments.length - 1], _bk_col_row_fig = Object.values(Bokeh.index)[0].child_views[0].child_views[0]
+			_bk_col_row_fig.export()._canvas""" + blob
+	v2 = """var done = arguments[arguments.length - 1]; document.querySelector(`canvas`)""" + blob
+	if isa(kind := wait_js(br, ready), int): raise Exception(kind) # Client/Server error
+	if kind is None: raise TimeoutException("spectrum not rendered in time") # retried by save()
+	if kind == "v2":
+		rv = exec_async_js(br, v2)
+	else: # v3
+		f, g = __dir__ / f"html/desi-{dr}-{id}.html", "</html>"
+		js = """fetch(location.href, {cache: `force-cache`}).then(r => r.ok ? r.text() : null)
+			.catch(() => null).then(arguments[arguments.length - 1])"""
+		rv = exec_async_js(br, js) # raw page source (from HTTP cache), without rendering view-source
+		if not isa(rv, str): raise JavascriptException("page source fetch failed")
+		write(f"{f}.orig", rv + "\n") if debug else None
+		write(f, rv[:rv.find(g) + len(g)] + "\n")
+		br.get(file2url(f)), wait_js(br, rendered)
+		rv = exec_async_js(br, v3)
+	if not isa(rv, str) or not rv.startswith("data:"): raise JavascriptException(f"canvas export failed ({kind})")
 	br.get(rv)
-	return url2bytes(rv)
+	return rv # data URL
 
 # Save spectrum image to disk
-def save(br: Browser, dr: Literal["edr", "dr1"], id: int | str, dst: Path | str = "", log_prefix: str = "") -> bool:
+def save(br: Browser, dr: Literal["edr", "dr1"], id: int | str, dst: Path | str = "", log_prefix: str = "", existing: Mapping[str, int] | None = None) -> bool:
 	dst = Path(dst or f"desi-{dr}-{id}.png")
 	br.switch_to.new_window() # new tab
-	if filesize(dst) > 0: return br.get(file2url(dst)) or True # already exists
-	br.get("about:logo"), br.switch_to.active_element.send_keys(netmonitor), sleep(1)
-	while True:
+	size = filesize(dst) if existing is None else existing.get(dst.name, 0)
+	if size > 0: return br.get(file2url(dst)) or True # already exists
+	if debug:
+		br.get("about:logo")
+		js = "return [innerWidth, innerHeight]"
+		viewport = exec_js(br, js)
+		br.switch_to.active_element.send_keys(netmonitor)
+		try: WebDriverWait(br, 2, 0.1).until(lambda br: exec_js(br, js) != viewport) # viewport shrinks once DevTools is docked
+		except TimeoutException: pass
+	for n in range(ntry := 5):
 		try:
 			data = load(br, dr, id)
 			break
-		except TimeoutException: sleep(3)
+		except TimeoutException: sleep(min(2 ** n + uniform(0, 1), 30)) if n + 1 < ntry else None # exponential backoff with jitter
 		except JavascriptException as e: # unlikely
-			print(log_prefix + "ignored", dr, id, f"\n{e}")
+			log.info("%signored %s %s\n%s", log_prefix, dr, id, e)
 			return False
-	write(dst, data)
-	print(log_prefix + "created", dr, id, "@", dst.as_posix())
+	else:
+		log.info("%stimeout %s %s", log_prefix, dr, id)
+		return False
+	url2file(data, dst)
+	log.info("%screated %s %s @ %s", log_prefix, dr, id, dst.as_posix())
 	return True
 
 def close_oldest(br: Browser, keep_ntab: int) -> None:
-	while len(br.window_handles) > max(keep_ntab, +1):
-		br.switch_to.window(br.window_handles[+0]) # oldest tab
+	handles = br.window_handles # fetch once, each access is a driver roundtrip
+	for h in handles[:-max(keep_ntab, +1)]: # oldest tabs
+		br.switch_to.window(h)
 		br.close()
 	else: # finally
-		br.switch_to.window(br.window_handles[-1]) # newest tab
+		br.switch_to.window(handles[-1]) # newest tab
+
+# Pool of warm browsers shared by workers, each one recycled after some uses to bound memory growth
+class BrowserPool:
+	def __init__(self, size: int, uses_per_browser: int = 50, grid: str = "", headless: bool = True) -> None:
+		self.idle, self.uses, self.uses_per_browser = Queue[Browser | None](), dict[Browser, int](), uses_per_browser
+		self.slot, self.grid, self.headless, self.alive, self.lock = dict[Browser, int](), grid, headless, size, Lock()
+		try:
+			for k in range(size): self.idle.put(self.new(k))
+		except BaseException:
+			self.close() # do not leak the browsers already started
+			raise
+
+	def __enter__(self) -> Self:
+		return self
+
+	def __exit__(self, *_) -> None:
+		self.close()
+
+	def new(self, k: int) -> Browser:
+		br = init(self.headless, __dir__ / f"cache/{k}", self.grid) # one disk cache per slot, as it cannot be shared
+		self.slot[br], self.uses[br] = k, 0
+		return br
+
+	def get(self) -> Browser:
+		if (br := self.idle.get()) is None: # no browser left
+			self.idle.put(None) # wake up the next waiter as well
+			raise RuntimeError("no browser left in the pool")
+		self.uses[br] += 1
+		return br
+
+	def put(self, br: Browser, broken: bool = False) -> None:
+		if broken or self.uses[br] >= self.uses_per_browser: # recycle
+			k = self.slot.pop(br)
+			del self.uses[br]
+			try: br.quit()
+			except Exception: pass
+			try: br = self.new(k)
+			except Exception as e:
+				with self.lock: self.alive = left = self.alive - 1
+				log.error("browser %d lost, %d left\n%s", k, left, e)
+				return self.idle.put(None) if left == 0 else None # fail the pool instead of hanging
+		self.idle.put(br)
+
+	def close(self) -> None:
+		while not self.idle.empty():
+			if (br := self.idle.get()) is None: continue
+			try: br.quit()
+			except Exception: pass # keep closing the others
+
+# Save spectrum image with a browser borrowed from the pool (selenium sessions are not thread-safe)
+def worker(pool: BrowserPool, dr: Literal["edr", "dr1"], id: int | str, dst: Path, progress: Callable[[], str], existing: Mapping[str, int]) -> bool:
+	log_prefix, br, broken = progress(), None, False
+	try:
+		br = pool.get()
+		ok = save(br, dr, id, dst, log_prefix, existing)
+		close_oldest(br, 2) # keep at most 2 tabs
+		return ok
+	except Exception as e: # report and move on to the next row
+		broken = isa(e, WebDriverException) # session may be dead, replace the browser
+		log.error("%sfailed %s %s\n%r", log_prefix, dr, id, e)
+		return False
+	finally: pool.put(br, broken) if br else None
 
 # Main program
 if __name__ == "__main__":
-	ff = init()
-	df = read_csv(__dir__ / "AWTQ_DESI_20250703DR1.tsv", sep="\t")
+	basicConfig(format="%(message)s", level=INFO, stream=stdout)
+	df = read_csv(__dir__ / "AWTQ_DESI_20250703DR1.tsv", sep="\t", usecols=["SDSS_NAME", "targetid"], dtype={"SDSS_NAME": "string", "targetid": "int64"})
 	df = df[:20]
 	dr: Final = "dr1"
+	nworker: Final = 5 # keep it low to avoid hammering the server
+	# e.g. "http://localhost:4444" for `docker run -d -p 4444:4444 -e SE_NODE_MAX_SESSIONS=5 -v $PWD/desi:$PWD/desi selenium/standalone-firefox`
+	# the node must see desi/ at the same path, for the Bokeh v3 fallback loads a local copy of the page
+	grid: Final = ""
 	path = __dir__ / "spec"
-	imgs, i = list[str](), 0
+	i = count(1)
 	nrow_ndigit = len(str(nrow := len(df)))
-	for row in eachrow(df):
-		img_name = f"{row.SDSS_NAME}-desi-{dr}-{row.targetid}.png"
-		progress = f"[%{nrow_ndigit}d/{nrow}] " % (i := i + 1)
-		save(ff, dr, row.targetid, path / img_name, progress) and imgs.append(img_name)
-		close_oldest(ff, 2) # keep at most 2 tabs
-	else: print("finished"), print(f"\n{len(imgs)} image(s) ready")
-	for x in imgs: print(x)
+	progress = lambda: f"[%{nrow_ndigit}d/{nrow}] " % next(i)
+	with scandir(path) as it: # one directory scan instead of stat calls per row
+		existing = {x.name: x.stat().st_size for x in it if x.is_file()}
+	jobs = list[tuple[str, Future[bool]]]()
+	with BrowserPool(nworker, grid=grid, headless=not debug) as pool, ThreadPoolExecutor(nworker) as exe:
+		for name, id in zip(df["SDSS_NAME"].to_numpy(), df["targetid"].to_numpy()):
+			img_name = f"{name}-desi-{dr}-{id}.png"
+			jobs.append((img_name, exe.submit(worker, pool, dr, id, path / img_name, progress, existing)))
+	imgs = [x for x, job in jobs if job.result()]
+	log.info("finished\n\n%d image(s) ready", len(imgs))
+	log.info("\n".join(imgs)) if imgs else None
 	# save(ff, "dr1", 39627802856653317) # https://www.legacysurvey.org/viewer/desi-spectrum/dr1/targetid39627802856653317 # v3.8.0 #!broken
 	# save(ff, "dr1", 39627848784285507) # https://www.legacysurvey.org/viewer/desi-spectrum/dr1/targetid39627848784285507 # v2.4.3
 	# save(ff, "dr1", 39627848784286649) # https://www.legacysurvey.org/viewer/desi-spectrum/dr1/targetid39627848784286649 # v2.4.3
-	ff.quit() # close the browser
 